@@ -21,9 +21,7 @@ CSV/JSON формат:
 
 import io
 import json
-import math
 import os
-import random
 from datetime import datetime, timedelta
 
 import numpy as np
@@ -46,6 +44,14 @@ TOTAL_QUESTIONS = 40
 TOTAL_VARIANTS = 4
 EXAM_DURATION_MIN = 100
 
+REQUIRED_COLUMNS = ["variant","qnum","type","question","correct","score"]
+OPTIONAL_COLUMNS = ["A","B","C","D","solution","topic","difficulty","tolerance"]
+BANK_DTYPES = {
+    "variant": "int32", "qnum": "int32", "score": "float64", "tolerance": "float64",
+    "type": object, "question": object, "A": object, "B": object, "C": object, "D": object,
+    "correct": object, "solution": object, "topic": object, "difficulty": object,
+}
+
 # ---------------------- STYLES ----------------------
 st.markdown(
     """
@@ -62,147 +68,264 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
+# ---------------------- PDF STYLES ----------------------
+@st.cache_resource(show_spinner=False)
+def _pdf_styles():
+    # Streamlit rerun бүрт script дахин ажилладаг тул загваруудыг process-д нэг удаа үүсгэнэ
+    doc_margins = dict(pagesize=A4, leftMargin=18*mm, rightMargin=18*mm, topMargin=14*mm, bottomMargin=14*mm)
+    topic_style = TableStyle([
+        ('BACKGROUND', (0,0), (-1,0), colors.HexColor('#e2e8f0')),
+        ('GRID', (0,0), (-1,-1), 0.25, colors.grey),
+        ('ALIGN', (1,1), (-1,-1), 'CENTER'),
+        ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+    ])
+    detail_style = TableStyle([
+        ('BACKGROUND', (0,0), (-1,0), colors.HexColor('#f1f5f9')),
+        ('GRID', (0,0), (-1,-1), 0.25, colors.grey),
+        ('ALIGN', (0,0), (-1,-1), 'CENTER'),
+        ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+    ])
+    return getSampleStyleSheet(), doc_margins, topic_style, detail_style
+
 # ---------------------- HELPERS ----------------------
-@st.cache_data(show_spinner=False)
+def _char_join(*parts) -> np.ndarray:
+    # np.char.add-ийг олон хэсэгт дараалан хэрэглэж мөр бүрийн текстийг нэг дор угсарна
+    out = np.asarray(parts[0]).astype(str)
+    for p in parts[1:]:
+        out = np.char.add(out, np.asarray(p).astype(str))
+    return out
+
+
+@st.cache_resource(show_spinner=False)
 def generate_demo_bank(seed: int = 12) -> pd.DataFrame:
-    random.seed(seed)
-    np.random.seed(seed)
-    rows = []
-    topics = ["Алгебр", "Функц/График", "Геометр", "Магадлал/Статистик"]
-    for v in range(1, TOTAL_VARIANTS + 1):
-        for q in range(1, TOTAL_QUESTIONS + 1):
-            topic = topics[(q-1) % len(topics)]
-            if q % 2 == 1:  # MCQ: шугаман тэгшитгэл / үндсэн логик
-                a = random.randint(2, 9)
-                b = random.randint(0, 9)
-                x = random.randint(1, 9)
-                c = a * x + b
-                qtext = f"{a}x + {b} = {c}. x-ийн утга?"
-                correct_val = x
-                options_vals = [correct_val, correct_val+1, correct_val-1, correct_val+2]
-                random.shuffle(options_vals)
-                correct_letter = "ABCD"[options_vals.index(correct_val)]
-                rows.append({
-                    "variant": v, "qnum": q, "type": "mcq", "question": qtext,
-                    "A": str(options_vals[0]), "B": str(options_vals[1]), "C": str(options_vals[2]), "D": str(options_vals[3]),
-                    "correct": correct_letter, "score": 1,
-                    "solution": f"{a}x = {c}-{b} ⇒ x={(c-b)//a}",
-                    "topic": topic, "difficulty": ["Easy","Medium","Hard"][q%3], "tolerance": ""
-                })
-            else:  # NUMERIC: тойргийн талбай, илэрхийлэл
-                r = random.randint(2, 12)
-                area = round(3.1416 * r * r, 2)
-                qtext = f"Радиус {r} см тойргийн талбайг π=3.1416 гэж тооцоод олоорой (см²)."
-                rows.append({
-                    "variant": v, "qnum": q, "type": "num", "question": qtext,
-                    "A": "", "B": "", "C": "", "D": "",
-                    "correct": area, "score": 1,
-                    "solution": f"S=πr²=3.1416×{r}²≈{area}",
-                    "topic": topic, "difficulty": ["Easy","Medium","Hard"][q%3], "tolerance": round(0.05*area,2)
-                })
-    return pd.DataFrame(rows)
+    rng = np.random.default_rng(seed)
+    n = TOTAL_VARIANTS * TOTAL_QUESTIONS
+    variants = np.repeat(np.arange(1, TOTAL_VARIANTS + 1), TOTAL_QUESTIONS)
+    qnums = np.tile(np.arange(1, TOTAL_QUESTIONS + 1), TOTAL_VARIANTS)
+    is_mcq = qnums % 2 == 1  # сондгой: MCQ шугаман тэгшитгэл, тэгш: тойргийн талбай
+    topics = np.array(["Алгебр", "Функц/График", "Геометр", "Магадлал/Статистик"])
+    difficulties = np.array(["Easy", "Medium", "Hard"])
+
+    a = rng.integers(2, 10, n)
+    b = rng.integers(0, 10, n)
+    x = rng.integers(1, 10, n)
+    r = rng.integers(2, 13, n)
+    c = a * x + b
+    area = np.round(3.1416 * r * r, 2)
+
+    opts = rng.permuted(np.stack([x, x + 1, x - 1, x + 2], axis=1), axis=1)
+    correct_idx = (opts == x[:, None]).argmax(1)
+    opts_txt = opts.astype(str)
+
+    mcq_q = _char_join(a, "x + ", b, " = ", c, ". x-ийн утга?")
+    num_q = _char_join("Радиус ", r, " см тойргийн талбайг π=3.1416 гэж тооцоод олоорой (см²).")
+    mcq_sol = _char_join(a, "x = ", c, "-", b, " ⇒ x=", x)
+    num_sol = _char_join("S=πr²=3.1416×", r, "²≈", area)
+
+    correct = area.astype(object)
+    correct[is_mcq] = np.array(list("ABCD"))[correct_idx[is_mcq]]
+    tolerance = np.round(0.05 * area, 2).astype(object)
+    tolerance[is_mcq] = ""
+
+    cols = {
+        "variant": variants, "qnum": qnums,
+        "type": np.where(is_mcq, "mcq", "num"),
+        "question": np.where(is_mcq, mcq_q, num_q),
+    }
+    for k, letter in enumerate("ABCD"):
+        cols[letter] = np.where(is_mcq, opts_txt[:, k], "")
+    cols.update({
+        "correct": correct, "score": np.ones(n, dtype=int),
+        "solution": np.where(is_mcq, mcq_sol, num_sol),
+        "topic": topics[(qnums - 1) % len(topics)],
+        "difficulty": difficulties[qnums % 3],
+        "tolerance": tolerance,
+    })
+    return pd.DataFrame(cols)
+
+
+def _read_bank_csv(upload) -> pd.DataFrame:
+    known = REQUIRED_COLUMNS + OPTIONAL_COLUMNS
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv
+    except ImportError:  # pyarrow суугаагүй бол C engine
+        return pd.read_csv(upload, engine='c', dtype=BANK_DTYPES, usecols=lambda c: c in known, low_memory=False)
+    # текст баганыг pyarrow-оор таамаглуулахгүй, уншихдаа шууд string болгоно (C engine-тэй ижил)
+    column_types = {
+        c: pa.string() if t is object else pa.from_numpy_dtype(np.dtype(t)) for c, t in BANK_DTYPES.items()
+    }
+    table = pa_csv.read_csv(upload, convert_options=pa_csv.ConvertOptions(
+        column_types=column_types, strings_can_be_null=True,
+    ))
+    df = table.to_pandas()
+    return df[[c for c in df.columns if c in known]]
 
 
 def load_bank_from_upload(upload) -> pd.DataFrame | None:
     if upload is None:
         return None
+    # ижил файлыг rerun бүрт дахин parse хийхгүй
+    cached = st.session_state.get('_upload_bank')
+    if cached is not None and cached[0] == upload.file_id:
+        return cached[1]
     name = upload.name.lower()
     try:
         if name.endswith('.csv'):
-            df = pd.read_csv(upload)
+            df = _read_bank_csv(upload)
         elif name.endswith('.json'):
-            df = pd.read_json(upload)
+            df = pd.read_json(upload, dtype=False)
+            df = df.astype({c: BANK_DTYPES[c] for c in ('variant', 'qnum') if c in df.columns})
+            for c in ('score', 'tolerance'):
+                if c in df.columns:
+                    df[c] = pd.to_numeric(df[c], errors='coerce')
         else:
             st.error('Зөвхөн CSV/JSON оруулна уу.')
             return None
     except Exception as e:
         st.error(f"Файл уншихад алдаа: {e}")
         return None
-    required = ["variant","qnum","type","question","correct","score"]
-    miss = [c for c in required if c not in df.columns]
+    miss = [c for c in REQUIRED_COLUMNS if c not in df.columns]
     if miss:
         st.error(f"Дутуу багана: {', '.join(miss)}")
         return None
-    df['variant'] = df['variant'].astype(int)
-    df['qnum'] = df['qnum'].astype(int)
+    st.session_state['_upload_bank'] = (upload.file_id, df)
     return df
 
 
+@st.cache_data(show_spinner=False)
+def get_variant(bank_df: pd.DataFrame, v: int) -> list[dict]:
+    # rerun бүрт шүүж эрэмбэлэхгүйн тулд хувилбарын мөрүүдийг dict болгон кэшлэнэ
+    df = bank_df[bank_df['variant'] == v].sort_values('qnum')
+    keys = zip(df['variant'].to_numpy(dtype=np.int32).tolist(), df['qnum'].to_numpy(dtype=np.int32).tolist())
+    opt_cols = [k for k in "ABCD" if k in df.columns]
+    # render-д хэрэгтэй утгуудыг баганаар нэг удаа тооцно
+    is_mcq = df['type'].astype(str).str.lower().eq('mcq')
+    if 'tolerance' in df.columns:
+        tol = pd.to_numeric(df['tolerance'], errors='coerce')
+        tol_txt = (" (±" + tol.astype(str) + ")").where(tol.notna() & ~is_mcq, "")
+    else:
+        tol_txt = pd.Series("", index=df.index)
+    answer_html = "Зөв хариулт: <span class='correct'>" + df['correct'].astype(str) + tol_txt + "</span>"
+    solution = df['solution'].fillna("").astype(str) if 'solution' in df.columns else pd.Series("", index=df.index)
+    rows = df.to_dict('records')
+    for row, key, mcq, ans, sol in zip(rows, keys, is_mcq.tolist(), answer_html.tolist(), solution.tolist()):
+        row['_key'] = key
+        row['_wkey'] = f"q_{key}"
+        row['_is_mcq'] = mcq
+        row['_answer_html'] = ans
+        row['_solution'] = sol
+        # зөвхөн байгаа сонголтуудыг нэг удаа шүүж, NaN шалгалтыг render-ээс гаргана
+        opts = [(k, str(row[k])) for k in opt_cols if pd.notna(row[k]) and str(row[k]) != ""]
+        row['_options'] = [k for k, _ in opts]
+        row['_captions'] = [f"{k}. {label}" for k, label in opts]
+    return rows
+
+
+def _check_numeric_series(user: pd.Series, correct: pd.Series, tol: pd.Series) -> np.ndarray:
+    u = pd.to_numeric(user.astype(str).str.strip().str.replace(',', '.'), errors='coerce')
+    c = pd.to_numeric(correct, errors='coerce')
+    t = pd.to_numeric(tol, errors='coerce').fillna(0.0)
+    return (np.abs(u - c) <= t).to_numpy() & u.notna().to_numpy()
+
+
 def check_numeric_answer(user_text: str, correct_value, tolerance=None) -> bool:
-    try:
-        if user_text is None or str(user_text).strip() == "":
-            return False
-        u = float(str(user_text).replace(',', '.'))
-        c = float(correct_value)
-        tol = float(tolerance) if tolerance not in (None, "", np.nan) else 0.0
-        return abs(u - c) <= tol
-    except Exception:
-        return False
+    return bool(_check_numeric_series(
+        pd.Series([user_text], dtype=object), pd.Series([correct_value], dtype=object), pd.Series([tolerance], dtype=object),
+    )[0])
+
+
+def _align_answers(bank: pd.DataFrame, answers: dict) -> np.ndarray:
+    keys = list(zip(bank['variant'].astype(int).tolist(), bank['qnum'].astype(int).tolist()))
+    return np.fromiter((answers.get(k) for k in keys), dtype=object, count=len(keys))
 
 
 def grade_exam(bank: pd.DataFrame, answers: dict):
-    details = []
-    total = 0.0
-    max_total = 0.0
-    for _, row in bank.iterrows():
-        key = (int(row.variant), int(row.qnum))
-        ans = answers.get(key, None)
-        ok = False
-        if str(row.type).lower() == 'mcq':
-            ok = (str(ans).upper() == str(row.correct).upper())
-        else:
-            ok = check_numeric_answer(ans, row.correct, row.get('tolerance', None))
-        s = float(row.score) if ok else 0.0
-        total += s
-        max_total += float(row.score)
-        details.append({
-            'variant': int(row.variant), 'qnum': int(row.qnum), 'type': row.type,
-            'topic': row.get('topic',''), 'difficulty': row.get('difficulty',''),
-            'correct': row.correct, 'your': ans, 'is_correct': ok, 'score': s, 'max_score': float(row.score)
-        })
-    return total, max_total, pd.DataFrame(details)
+    # мөр бүрээр давталгүй MCQ болон тоон маскийг нэг дор тооцно
+    ans_series = pd.Series(_align_answers(bank, answers), index=bank.index, dtype=object)
+    ans_text = ans_series.astype(str)
+    is_mcq = bank['type'].astype(str).str.lower().eq('mcq')
+    mcq_ok = bank['correct'].astype(str).str.upper().eq(ans_text.str.upper())
+    tol_series = bank['tolerance'] if 'tolerance' in bank.columns else pd.Series(0.0, index=bank.index)
+    num_ok = _check_numeric_series(ans_series, bank['correct'], tol_series)
+    ok_mask = np.where(is_mcq.to_numpy(), mcq_ok.to_numpy(), num_ok)
+    max_arr = bank['score'].to_numpy(dtype=float)
+    score_arr = np.where(ok_mask, max_arr, 0.0)
+    detail_df = pd.DataFrame({
+        'variant': bank['variant'].to_numpy(dtype=int), 'qnum': bank['qnum'].to_numpy(dtype=int),
+        'type': bank['type'].to_numpy(),
+        'topic': bank['topic'].to_numpy() if 'topic' in bank.columns else '',
+        'difficulty': bank['difficulty'].to_numpy() if 'difficulty' in bank.columns else '',
+        'correct': bank['correct'].to_numpy(), 'your': ans_series.to_numpy(),
+        'is_correct': ok_mask.astype(bool), 'score': score_arr, 'max_score': max_arr,
+    })
+    return float(score_arr.sum()), float(max_arr.sum()), detail_df
 
 
-def to_pdf_report(username: str, classroom: str, variant: int, summary: dict, detail_df: pd.DataFrame) -> bytes:
+@st.cache_data(show_spinner=False)
+def build_result_csv(detail_records: tuple, columns: tuple, username: str, classroom: str, ts: str) -> bytes:
+    result_df = pd.DataFrame(list(detail_records), columns=list(columns))
+    result_df.insert(0, 'username', username)
+    result_df.insert(1, 'classroom', classroom)
+    result_df.insert(2, 'timestamp', ts)
+    return result_df.to_csv(index=False).encode('utf-8-sig')
+
+
+@st.cache_data(show_spinner=False)
+def build_bank_csv(bank_df: pd.DataFrame) -> bytes:
+    return bank_df.to_csv(index=False).encode('utf-8-sig')
+
+
+@st.cache_data(show_spinner=False)
+def detail_view(detail_df: pd.DataFrame) -> pd.DataFrame:
+    return detail_df.drop(columns=['variant']).sort_values('qnum')
+
+
+def topic_breakdown(detail_df: pd.DataFrame) -> list[list]:
+    # groupby-agg-ын оронд эрэмбэлсэн кодууд дээр np.add.reduceat
+    codes, uniques = pd.factorize(detail_df['topic'], sort=True, use_na_sentinel=False)
+    if len(codes) == 0:
+        return []
+    order = np.argsort(codes, kind='stable')
+    sc = codes[order]
+    ic = detail_df['is_correct'].to_numpy()[order].astype(np.int32)
+    sc_b = detail_df['score'].to_numpy(dtype=float)[order]
+    splits = np.flatnonzero(np.diff(sc, prepend=-1))
+    correct_by = np.add.reduceat(ic, splits)
+    total_by = np.diff(np.append(splits, len(sc)))
+    score_by = np.add.reduceat(sc_b, splits)
+    return [list(r) for r in zip(uniques[sc[splits]].tolist(), correct_by.tolist(), total_by.tolist(), score_by.tolist())]
+
+
+@st.cache_data(show_spinner=False)
+def build_pdf(username: str, classroom: str, variant: int, generated_at: str,
+              total: float, max_total: float, correct_cnt: int, wrong_cnt: int,
+              spent_min: int, spent_sec: int, topic_rows: tuple, detail_rows: tuple) -> bytes:
     buf = io.BytesIO()
-    doc = SimpleDocTemplate(buf, pagesize=A4, leftMargin=18*mm, rightMargin=18*mm, topMargin=14*mm, bottomMargin=14*mm)
-    styles = getSampleStyleSheet()
+    styles, doc_margins, topic_style, detail_style = _pdf_styles()
+    doc = SimpleDocTemplate(buf, **doc_margins)
     elems = []
     elems.append(Paragraph(f"ЭЕШ Математик — Жишиг тест тайлан (Хувилбар {variant})", styles['Title']))
-    meta = f"Сурагч: <b>{username or '-'}</b> | Анги: <b>{classroom or '-'}</b> | Огноо: {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+    meta = f"Сурагч: <b>{username or '-'}</b> | Анги: <b>{classroom or '-'}</b> | Огноо: {generated_at}"
     elems.append(Paragraph(meta, styles['Normal']))
     elems.append(Spacer(1, 8))
-    score_line = f"Нийт оноо: <b>{summary['total']}</b> / {summary['max_total']}  (Зөв: {summary['correct_cnt']}, Буруу: {summary['wrong_cnt']})"
-    time_line = f"Зарцуулагдсан: {summary['spent_min']} мин {summary['spent_sec']} сек"
+    score_line = f"Нийт оноо: <b>{total}</b> / {max_total}  (Зөв: {correct_cnt}, Буруу: {wrong_cnt})"
+    time_line = f"Зарцуулагдсан: {spent_min} мин {spent_sec} сек"
     elems.append(Paragraph(score_line, styles['Heading3']))
     elems.append(Paragraph(time_line, styles['Normal']))
     elems.append(Spacer(1, 6))
     # Topic breakdown
-    tb = summary.get('topic_breakdown')
-    if isinstance(tb, pd.DataFrame) and not tb.empty:
-        data = [["Сэдэв", "Зөв", "Нийт", "Оноо"]] + tb.values.tolist()
+    if topic_rows:
+        data = [["Сэдэв", "Зөв", "Нийт", "Оноо"]] + [list(r) for r in topic_rows]
         table = Table(data, colWidths=[70*mm, 20*mm, 20*mm, 20*mm])
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0,0), (-1,0), colors.HexColor('#e2e8f0')),
-            ('GRID', (0,0), (-1,-1), 0.25, colors.grey),
-            ('ALIGN', (1,1), (-1,-1), 'CENTER'),
-            ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-        ]))
+        table.setStyle(topic_style)
         elems.append(Paragraph("Сэдвийн тайлбар", styles['Heading3']))
         elems.append(table)
         elems.append(Spacer(1, 6))
     # Details
     header = ["#", "Төрөл", "Зөв", "Таны", "Оноо"]
-    rows = []
-    for _, r in detail_df.sort_values('qnum').iterrows():
-        rows.append([int(r.qnum), str(r.type).upper(), str(r.correct), str(r.your), f"{r.score}/{r.max_score}"])
-    t2 = Table([header] + rows, colWidths=[12*mm, 18*mm, 28*mm, 28*mm, 20*mm])
-    t2.setStyle(TableStyle([
-        ('BACKGROUND', (0,0), (-1,0), colors.HexColor('#f1f5f9')),
-        ('GRID', (0,0), (-1,-1), 0.25, colors.grey),
-        ('ALIGN', (0,0), (-1,-1), 'CENTER'),
-        ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-    ]))
+    t2 = Table([header] + [list(r) for r in detail_rows], colWidths=[12*mm, 18*mm, 28*mm, 28*mm, 20*mm])
+    t2.setStyle(detail_style)
     elems.append(Paragraph("Асуултын дэлгэрэнгүй", styles['Heading3']))
     elems.append(t2)
     doc.build(elems)
@@ -210,6 +333,25 @@ def to_pdf_report(username: str, classroom: str, variant: int, summary: dict, de
     buf.close()
     return pdf
 
+
+def to_pdf_report(username: str, classroom: str, variant: int, summary: dict, detail_df: pd.DataFrame) -> bytes:
+    # cache_data-д hash хийгдэхийн тулд DataFrame-уудыг tuple болгоно
+    topic_rows = tuple(map(tuple, summary.get('topic_breakdown') or ()))
+    sorted_df = detail_df.sort_values('qnum')
+    arr = np.column_stack([
+        sorted_df['qnum'].astype(int).astype(str).to_numpy(),
+        sorted_df['type'].astype(str).str.upper().to_numpy(),
+        sorted_df['correct'].astype(str).to_numpy(),
+        sorted_df['your'].astype(str).to_numpy(),
+        (sorted_df['score'].astype(str) + '/' + sorted_df['max_score'].astype(str)).to_numpy(),
+    ])
+    detail_rows = tuple(map(tuple, arr.tolist()))
+    return build_pdf(
+        username, classroom, int(variant), summary['generated_at'],
+        summary['total'], summary['max_total'], summary['correct_cnt'], summary['wrong_cnt'],
+        summary['spent_min'], summary['spent_sec'], topic_rows, detail_rows,
+    )
+
 # ---------------------- SIDEBAR ----------------------
 st.sidebar.header("Тохиргоо")
 role = st.sidebar.selectbox("Эрх", ["Сурагч", "Багш/Админ"])
@@ -228,7 +370,12 @@ ss = st.session_state
 if 'started' not in ss: ss.started = False
 if 'submitted' not in ss: ss.submitted = False
 if 'start_time' not in ss: ss.start_time = None
+if 'submit_time' not in ss: ss.submit_time = None
+if 'auto_submit' not in ss: ss.auto_submit = False
+if 'graded_at' not in ss: ss.graded_at = None
+if 'exam_rows' not in ss: ss.exam_rows = []
 if 'answers' not in ss: ss.answers = {}
+if 'answered_count' not in ss: ss.answered_count = 0
 if 'active_variant' not in ss: ss.active_variant = 1
 
 # ---------------------- PREP GUIDE ----------------------
@@ -262,9 +409,35 @@ with colC:
 with colD:
     pass
 
-variant_df = bank_df[bank_df['variant'] == v].sort_values('qnum').reset_index(drop=True)
-if len(variant_df) < TOTAL_QUESTIONS:
-    st.warning(f"Хувилбар {v} дээр {len(variant_df)} асуулт байна. {TOTAL_QUESTIONS} байх ёстой.")
+variant_rows = get_variant(bank_df, v)
+if len(variant_rows) < TOTAL_QUESTIONS:
+    st.warning(f"Хувилбар {v} дээр {len(variant_rows)} асуулт байна. {TOTAL_QUESTIONS} байх ёстой.")
+
+# ---------------------- TIMER ----------------------
+def _remaining(now: datetime) -> timedelta:
+    return max(timedelta(minutes=EXAM_DURATION_MIN) - (now - ss.start_time), timedelta(seconds=0))
+
+
+def _timer_markdown(remain: timedelta):
+    mins = int(remain.total_seconds() // 60)
+    secs = int(remain.total_seconds() % 60)
+    st.markdown(f"<span class='timer'>⏱ Үлдсэн хугацаа: {mins:02d}:{secs:02d}</span>", unsafe_allow_html=True)
+
+
+@st.fragment(run_every=1.0)
+def render_timer():
+    # зөвхөн таймер секунд тутам дахин ажиллана; асуултууд дахин зурагдахгүй
+    remain = _remaining(datetime.now())
+    _timer_markdown(remain)
+    if remain.total_seconds() <= 0 and not ss.submitted:
+        ss.auto_submit = True
+        st.rerun()
+
+
+if ss.auto_submit and ss.started and not ss.submitted:
+    ss.submitted = True
+    ss.submit_time = ss.start_time + timedelta(minutes=EXAM_DURATION_MIN)
+ss.auto_submit = False
 
 # ---------------------- CONTROLS (Start/Save/Submit) ----------------------
 ctrl = st.container()
@@ -278,6 +451,9 @@ with ctrl:
                 ss.start_time = datetime.now()
                 ss.submitted = False
                 ss.answers = {}
+                ss.answered_count = 0
+                # дүгнэлтэд ашиглах асуултуудыг эхлэх үеийн сангаас хадгална
+                ss.exam_rows = variant_rows
                 st.rerun()
         else:
             st.success(f"Хувилбар {v} идэвхтэй")
@@ -289,38 +465,36 @@ with ctrl:
         if ss.started and not ss.submitted:
             if st.button("🛑 Дуусгах/Илгээх", use_container_width=True):
                 ss.submitted = True
+                ss.submit_time = datetime.now()
                 st.rerun()
     with c4:
-        if ss.started:
-            elapsed = datetime.now() - ss.start_time
-            remain = max(timedelta(minutes=EXAM_DURATION_MIN) - elapsed, timedelta(seconds=0))
-            mins = int(remain.total_seconds() // 60)
-            secs = int(remain.total_seconds() % 60)
-            st.markdown(f"<span class='timer'>⏱ Үлдсэн хугацаа: {mins:02d}:{secs:02d}</span>", unsafe_allow_html=True)
-            if remain.total_seconds() <= 0 and not ss.submitted:
+        if ss.started and not ss.submitted:
+            render_timer()
+        elif ss.started:
+            remain = _remaining(ss.submit_time)
+            _timer_markdown(remain)
+            if remain.total_seconds() <= 0:
                 st.warning("Хугацаа дууслаа. Автоматаар илгээв.")
-                ss.submitted = True
-                st.rerun()
 
 # ---------------------- QUESTION RENDER ----------------------
 
+def _store_answer(q_key, prev, new):
+    # хоосон ↔ бөглөсөн шилжилтээр хариулсан тоог O(1)-ээр шинэчилнэ
+    ss.answered_count += int(prev in (None, "")) - int(new in (None, ""))
+    ss.answers[q_key] = new
+
+
 def render_question(row):
-    q_key = (int(row.variant), int(row.qnum))
-    st.markdown(f"<div class='qhead'>Асуулт #{int(row.qnum)}</div>", unsafe_allow_html=True)
-    st.write(row.question)
+    q_key = row['_key']
+    st.markdown(f"<div class='qhead'>Асуулт #{q_key[1]}</div>", unsafe_allow_html=True)
+    st.write(row['question'])
 
     disabled = (not ss.started) or ss.submitted or (ss.active_variant != v)
     prev = ss.answers.get(q_key)
 
-    if str(row.type).lower() == 'mcq':
-        opt_keys = ["A","B","C","D"]
-        # зөвхөн байгаа сонголтуудыг дүүргэнэ
-        options = [k for k in opt_keys if k in row.index and pd.notna(row[k])]
-        labels = []
-        for k in options:
-            label = row[k]
-            label = "" if (isinstance(label, float) and math.isnan(label)) else str(label)
-            labels.append(f"{k}. {label}")
+    if row['_is_mcq']:
+        options = row['_options']
+        labels = row['_captions']
         if not options:
             st.warning("Энэ асуултад сонголт алга")
             st.divider()
@@ -334,27 +508,22 @@ def render_question(row):
             label="Сонголт",
             options=options,
             index=sel_index,
-            key=f"q_{q_key}",
+            key=row['_wkey'],
             horizontal=True,
             disabled=disabled,
             captions=labels,
         )
         if not disabled:
-            ss.answers[q_key] = choice
+            _store_answer(q_key, prev, choice)
     else:
-        val = st.text_input("Хариу (тоо)", value=str(prev) if prev not in (None, 'None') else "", key=f"q_{q_key}", disabled=disabled)
+        val = st.text_input("Хариу (тоо)", value=str(prev) if prev not in (None, 'None') else "", key=row['_wkey'], disabled=disabled)
         if not disabled:
-            ss.answers[q_key] = val
+            _store_answer(q_key, prev, val)
 
     with st.expander("Тайлбар/Шийд (илгээсэний дараа)"):
         if ss.submitted:
-            if str(row.type).lower() == 'mcq':
-                st.markdown(f"Зөв хариулт: <span class='correct'>{row.correct}</span>", unsafe_allow_html=True)
-            else:
-                tol = row.get('tolerance', '')
-                tol_txt = f" (±{tol})" if tol not in (None, "", np.nan) else ""
-                st.markdown(f"Зөв хариулт: <span class='correct'>{row.correct}{tol_txt}</span>", unsafe_allow_html=True)
-            st.write(row.get('solution',''))
+            st.markdown(row['_answer_html'], unsafe_allow_html=True)
+            st.write(row['_solution'])
         else:
             st.markdown("<span class='muted'>Илгээсний дараа харагдана</span>", unsafe_allow_html=True)
     st.divider()
@@ -363,7 +532,7 @@ left, right = st.columns([3,1])
 with left:
     st.markdown("<div class='card'>", unsafe_allow_html=True)
     if ss.started:
-        for _, row in variant_df.iterrows():
+        for row in variant_rows:
             render_question(row)
     else:
         st.info("Хувилбар сонгоод 'Эхлүүлэх' дарна уу.")
@@ -371,54 +540,63 @@ with left:
 with right:
     st.subheader("Явц")
     if ss.started:
-        answered = sum(1 for (vk,qk), val in ss.answers.items() if vk==ss.active_variant and (val not in (None, "")))
-        st.progress(answered / max(1, len(variant_df)))
-        st.write(f"Хариулсан: {answered} / {len(variant_df)})")
+        answered = ss.answered_count
+        st.progress(answered / max(1, len(variant_rows)))
+        st.write(f"Хариулсан: {answered} / {len(variant_rows)})")
         st.caption("Шуурхай навигаци")
-        cols = st.columns(5)
-        for i, (_, row) in enumerate(variant_df.iterrows()):
-            key = (int(row.variant), int(row.qnum))
-            filled = (key in ss.answers) and (ss.answers[key] not in (None, ""))
-            cols[i%5].button(f"{int(row.qnum)}", type=("primary" if filled else "secondary"))
+        # 40 товчны оронд нэг HTML блок: ногоон = хариулсан, улаан = хоосон
+        pills = "".join(
+            f"<span class='pill' style='background:{'#bbf7d0' if ss.answers.get(row['_key']) not in (None, '') else '#fecaca'}'>{row['_key'][1]}</span>"
+            for row in variant_rows
+        )
+        st.markdown(f"<div style='line-height:2'>{pills}</div>", unsafe_allow_html=True)
 
 # ---------------------- RESULTS ----------------------
-if ss.submitted and ss.started:
-    total, max_total, detail_df = grade_exam(variant_df, ss.answers)
-    correct_cnt = int(detail_df['is_correct'].sum())
-    wrong_cnt = len(detail_df) - correct_cnt
+@st.fragment
+def render_detail_table(detail_df: pd.DataFrame):
+    # хүснэгтийг нээсэн үед л зурна; toggle нь зөвхөн энэ fragment-ийг дахин ажиллуулна
+    if st.toggle("Дэлгэрэнгүй хүснэгт", key="_show_detail"):
+        st.dataframe(detail_view(detail_df), hide_index=True, use_container_width=True)
+
+
+if ss.submitted and ss.started and not ss.exam_rows:
+    st.warning("Илгээсэн хувилбарын асуултууд олдсонгүй. Тестээ дахин эхлүүлнэ үү.")
+elif ss.submitted and ss.started:
+    # илгээсний дараа хариулт өөрчлөгдөхгүй тул нэг удаа дүгнэж, summary-г session-д хадгална
+    # snapshot нь эхлэх үед авагдсан тул (start_time, submit_time) нь оролдлогыг тодорхойлно
+    graded_key = (ss.start_time, ss.submit_time)
+    if ss.graded_at != graded_key:
+        exam_df = pd.DataFrame(ss.exam_rows)
+        total, max_total, detail_df = grade_exam(exam_df, ss.answers)
+        ok = detail_df['is_correct'].to_numpy()
+        correct_cnt = int(ok.sum())
+        spent = (ss.submit_time - ss.start_time).total_seconds()
+        ss.graded = (detail_df, {
+            'total': total, 'max_total': max_total,
+            'correct_cnt': correct_cnt, 'wrong_cnt': ok.size - correct_cnt,
+            'spent_min': int(spent // 60), 'spent_sec': int(spent % 60),
+            'generated_at': ss.submit_time.strftime('%Y-%m-%d %H:%M'),
+            'topic_breakdown': topic_breakdown(detail_df) if 'topic' in exam_df.columns else [],
+        })
+        ss.graded_at = graded_key
+    detail_df, summary = ss.graded
+    total, max_total = summary['total'], summary['max_total']
     percent = 0 if max_total == 0 else round(100*total/max_total,1)
 
-    st.success(f"Дүн: {total} / {max_total}  ({percent}%) • Зөв: {correct_cnt} • Буруу: {wrong_cnt}")
-
-    # Topic breakdown
-    if 'topic' in variant_df.columns:
-        topic_grp = detail_df.groupby('topic', dropna=False).agg(
-            Зөв=("is_correct","sum"), Нийт=("is_correct","count"), Оноо=("score","sum")
-        ).reset_index().rename(columns={"topic":"Сэдэв"})
-    else:
-        topic_grp = pd.DataFrame()
+    st.success(f"Дүн: {total} / {max_total}  ({percent}%) • Зөв: {summary['correct_cnt']} • Буруу: {summary['wrong_cnt']}")
 
-    with st.expander("Дэлгэрэнгүй хүснэгт"):
-        st.dataframe(detail_df.drop(columns=['variant']).sort_values('qnum'), use_container_width=True)
+    render_detail_table(detail_df)
 
     # CSV download
-    result_df = detail_df.copy()
-    result_df.insert(0, 'username', username)
-    result_df.insert(1, 'classroom', classroom)
-    result_df.insert(2, 'timestamp', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-    csv_bytes = result_df.to_csv(index=False).encode('utf-8-sig')
-    st.download_button("CSV татах", data=csv_bytes, file_name=f"result_variant{v}.csv", mime="text/csv")
+    csv_bytes = build_result_csv(
+        tuple(detail_df.itertuples(index=False, name=None)), tuple(detail_df.columns),
+        username, classroom, ss.submit_time.strftime('%Y-%m-%d %H:%M:%S'),
+    )
+    st.download_button("CSV татах", data=csv_bytes, file_name=f"result_variant{ss.active_variant}.csv", mime="text/csv")
 
     # PDF download
-    summary = {
-        'total': total, 'max_total': max_total,
-        'correct_cnt': correct_cnt, 'wrong_cnt': wrong_cnt,
-        'spent_min': int((datetime.now()-ss.start_time).total_seconds()//60),
-        'spent_sec': int((datetime.now()-ss.start_time).total_seconds()%60),
-        'topic_breakdown': topic_grp if not topic_grp.empty else pd.DataFrame(),
-    }
-    pdf_bytes = to_pdf_report(username, classroom, v, summary, detail_df)
-    st.download_button("PDF тайлан татах", data=pdf_bytes, file_name=f"report_variant{v}.pdf", mime="application/pdf")
+    pdf_bytes = to_pdf_report(username, classroom, ss.active_variant, summary, detail_df)
+    st.download_button("PDF тайлан татах", data=pdf_bytes, file_name=f"report_variant{ss.active_variant}.pdf", mime="application/pdf")
 
 # ---------------------- TEACHER PANEL ----------------------
 if role == "Багш/Админ":
@@ -427,6 +605,6 @@ if role == "Багш/Админ":
     st.caption("Импортолсон/демо сангийн эхний мөрүүд")
     st.dataframe(bank_df.head(20), use_container_width=True)
     st.caption("Формат: variant,qnum,type,question,A,B,C,D,correct,score,solution,topic,difficulty,tolerance")
-    st.download_button("Жишээ CSV татах (одоогийн сангаас)", data=bank_df.to_csv(index=False).encode('utf-8-sig'), file_name='sample_bank.csv', mime='text/csv')
+    st.download_button("Жишээ CSV татах (одоогийн сангаас)", data=build_bank_csv(bank_df), file_name='sample_bank.csv', mime='text/csv')
 
 st.caption("© 2025 • Streamlit")